@@ -23,8 +23,10 @@ import subprocess
 from sys import argv
 import sys
 import argparse
+import multiprocessing
 from pathlib import Path
 import json
+import numpy as np
 import pandas as pd
 import shutil
 import re
@@ -84,7 +86,15 @@ Options:
           LOCAL mode: very-fast-local, fast-local, sensitive-local, 
                       very-sensitive-local
           DEFAULT = fast
-    -th   Number of used threads in the bowtie2 mapping step. Default = 6
+    -th   Number of used threads in the bowtie2 mapping step. Default =
+          the available cores capped at 16; bowtie2 stops scaling
+          past that point
+    -it   Number of additional threads used by samtools for BGZF
+          (de)compression in the sort/view/index steps.
+          Default = half the available cores
+    -pl   Number of samples that are processed in parallel. Each
+          sample runs its own bowtie2+samtools pipeline, so the -th
+          and -it budgets are divided over the workers. Default = 1
 ______________________________________________________________________
 
 ''')
@@ -103,7 +113,11 @@ ______________________________________________________________________
     parser.add_argument( "-s", "--bowtie2_setting", help=argparse.SUPPRESS,
                          type=str, required = False, default="fast")
     parser.add_argument( "-th", "--threads", help=argparse.SUPPRESS,
-                         type=int, required = False, default=6)
+                         type=int, required = False, default=min(os.cpu_count(), 16))
+    parser.add_argument( "-it", "--io_threads", help=argparse.SUPPRESS,
+                         type=int, required = False, default=max(1, os.cpu_count()//2))
+    parser.add_argument( "-pl", "--parallel", help=argparse.SUPPRESS,
+                         type=int, required = False, default=1)
     return(parser, parser.parse_args())
 
 ######################################################################
@@ -125,15 +139,19 @@ def bowtie2_index(reference, outdir):
         stem = Path(reference).stem
         index_name = f"{outdir}{stem}"
         if not os.path.exists(index_name + ".1.bt2"):
-            cmd_bowtie2_index = f"bowtie2-build {reference} {index_name}"
-            res_index = subprocess.check_output(cmd_bowtie2_index, shell=True)
+            cmd_bowtie2_index = ["bowtie2-build", reference, index_name]
+            res_index = subprocess.run(cmd_bowtie2_index, check=True, stdout=subprocess.DEVNULL)
     except(subprocess.CalledProcessError):
         print("Error-code M3:001, check error table")
         # Proper error here, also exit code
     return(index_name)
 
-def bowtie2_map(outdir, mate1, mate2, index, fasta, bowtie2_setting, threads):
-    """Maps the .fq file to the reference (fasta)
+def bowtie2_map_sort(outdir, mate1, mate2, index, fasta, bowtie2_setting, threads, io_threads, reference):
+    """Maps the .fq file to the reference (fasta) and sorts the result
+    The bowtie2 SAM output is piped directly into samtools sort, so
+    that no intermediate .sam or unsorted .bam is ever written to
+    disk. The sorted result is stored as CRAM, which compresses
+    30-60% smaller than BAM against the reference.
     parameters
     ----------
     outdir
@@ -148,38 +166,55 @@ def bowtie2_map(outdir, mate1, mate2, index, fasta, bowtie2_setting, threads):
         string, the build-in setting for bowtie2
     threads
         int, number of threads used in the alignment
+    io_threads
+        int, number of additional samtools compression threads
+    reference
+        string, the name of the reference fasta file (GCFs)
     returns
     ----------
-    samfile = the .sam filename that contains all the results
+    sortedcram = the sorted .cram filename that contains all the results
     writes the mapping percentage to bowtie2_log.txt
     """
     stem = Path(mate1).stem
     sample = stem.split("_")[0]
-    samfile = f"{outdir}{sample}.sam"
+    sortedcram = f"{outdir}{sample}.sorted.cram"
     # In the case of unpaired, m1 and m2 are identical. Thus the following works:
-    sample_command = f"-U {mate1}" if mate1 == mate2 else f"-1 {mate1} -2 {mate2}"
-    try:
-        if not os.path.exists(samfile):
-            cmd_bowtie2_map = f"bowtie2\
-            --{bowtie2_setting}\
-            --no-unal\
-            --threads {threads} \
-            {'-f' if fasta else ''} \
-            -x {index} \
-            {sample_command}\
-            -S {samfile}" #  The .sam file will contain only the map results for 1 sample
-            
-            print(f"the following command will be executed by bowtie2:\n\
+    sample_command = ["-U", mate1] if mate1 == mate2 else ["-1", mate1, "-2", mate2]
+    if not os.path.exists(sortedcram):
+        cmd_bowtie2_map = ["bowtie2",
+                           f"--{bowtie2_setting}",
+                           "--no-unal",
+                           "--threads", str(threads)]
+        if fasta:
+            cmd_bowtie2_map.append("-f")
+        cmd_bowtie2_map += ["-x", index] + sample_command
+        cmd_sort = ["samtools", "sort", "-@", str(io_threads),
+                    "--output-fmt", "cram", "--reference", reference,
+                    "-o", sortedcram, "-"]
+
+        print(f"the following command will be executed by bowtie2:\n\
 _____________________________________________________\n\
-{cmd_bowtie2_map}\n\
+{' '.join(cmd_bowtie2_map)} | {' '.join(cmd_sort)}\n\
 _____________________________________________________\n")
-            res_map = subprocess.check_output(cmd_bowtie2_map, shell=True, stderr = subprocess.STDOUT)
-            # Saving mapping percentage:
-            with open(f"{outdir}bowtie2_log.txt", "a+") as f:
-                f.write(f"#{sample}\n{res_map.decode('utf-8')}")
-    except(subprocess.CalledProcessError):
-        pass # raise error here
-    return(samfile)
+        #  The .cram file will contain only the map results for 1 sample
+        p_map = subprocess.Popen(cmd_bowtie2_map, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        p_sort = subprocess.Popen(cmd_sort, stdin = p_map.stdout)
+        p_map.stdout.close() # let p_sort see the end of the stream
+        res_map = p_map.stderr.read() # bowtie2 reports on stderr
+        p_map.wait()
+        p_sort.wait()
+        if p_map.returncode != 0 or p_sort.returncode != 0:
+            # a half-written output would pass the exists() guard on a re-run
+            if os.path.exists(sortedcram):
+                os.remove(sortedcram)
+            if p_map.returncode != 0:
+                raise subprocess.CalledProcessError(p_map.returncode, " ".join(cmd_bowtie2_map),
+                                                    stderr=res_map)
+            raise subprocess.CalledProcessError(p_sort.returncode, " ".join(cmd_sort))
+        # Saving mapping percentage:
+        with open(f"{outdir}bowtie2_log.txt", "a+") as f:
+            f.write(f"#{sample}\n{res_map.decode('utf-8')}")
+    return(sortedcram)
 
 def parse_perc(outdir):
     """parses the percentage from the bowtie2 stdout
@@ -208,51 +243,7 @@ def parse_perc(outdir):
 ######################################################################
 # Functions for reading SAM and BAM files
 ######################################################################
-def samtobam(sam, outdir):
-    """converts .sam to .bam using samtools view
-    parameters:
-    ----------
-    sam 
-        string, name of the outputted bowtie2 mapping
-    outdir
-        string, the path of the output directory
-    returns
-    ----------
-    bamfile = the name of the .bam file
-    """
-    stem = Path(sam).stem
-    bamfile = f"{outdir}{stem}.bam"
-    try:
-        cmd_samtobam = f"samtools view\
-        -b {sam}\
-        > {bamfile}"
-        res_samtobam = subprocess.check_output(cmd_samtobam, shell=True)
-    except(subprocess.CalledProcessError):
-        pass # raise error here
-    return(bamfile)
-
-def sortbam(bam, outdir):
-    """sorts the bam file
-    parameters
-    ----------
-    bam
-        string, the name of the accession bamfile, ".bam"-file
-    outdir
-        string, the path of the output directory
-    returns
-    ----------
-    sortedbam = name of the sorted bam file
-    """
-    stem = Path(bam).stem
-    sortedbam = f"{outdir}{stem}.sorted.bam"
-    try:
-        cmd_sortbam = f"samtools sort {bam} > {sortedbam}"
-        res_sortbam = subprocess.check_output(cmd_sortbam, shell=True)
-    except(subprocess.CalledProcessError):
-        pass # raise error here
-    return(sortedbam)
-
-def indexbam(sortedbam, outdir):
+def indexbam(sortedbam, outdir, io_threads):
     """Builds a bam index
     parameters
     ----------
@@ -260,402 +251,243 @@ def indexbam(sortedbam, outdir):
         string, the name of the sorted bam file
     outdir
         string, the path of the output directory
+    io_threads
+        int, number of additional samtools compression threads
     returns
     ----------
     none
     """
     try:
-        cmd_bam_index = f"samtools index {sortedbam}"
-        res_index = subprocess.check_output(cmd_bam_index, shell=True)
+        cmd_bam_index = ["samtools", "index", "-@", str(io_threads), sortedbam]
+        res_index = subprocess.run(cmd_bam_index, check=True)
     except(subprocess.CalledProcessError):
         pass # raise error here
     return()
 
-def countbam(sortedbam, outdir):
-    """calculates the raw counts from a BAM index
-    parameters
-    ----------
-    sortedbam
-        string, the name of the sorted bam file
-    outdir
-        string, the path of the output directory
-    returns
-    ----------
-    counts_file = file containing the counts
-    """
-    counts_file = f"{sortedbam[:-3]}count"
-    try:
-        cmd_count = f"samtools idxstats {sortedbam} > {counts_file}"
-        res_count = subprocess.check_output(cmd_count, shell=True)
-    except(subprocess.CalledProcessError):
-        pass # raise error here
-    return(counts_file)
-
-def extractcorefrombam(bam, outdir, bedfile):
-    """extracts regions in bedfile format from bam file
+def extractcorefrombam(cram, outdir, bedfile, io_threads, reference):
+    """extracts regions in bedfile format from the alignment file
     parameters:
     ----------
-    bam 
-        string, the name of the accession bamfile, ".bam"-file
+    cram
+        string, the name of the accession alignment, ".cram"-file
     outdir
         string, the path of the output directory
     bedfile
         the name of the bedfile with core coordinates
+    io_threads
+        int, number of additional samtools compression threads
+    reference
+        string, the name of the reference fasta file (GCFs)
     returns
     ----------
-    bamfile = the name of the .bam file
+    corecram = the name of the sorted and indexed core .cram file
     """
-    #  samtools view -b -L BiG-MAP.enzymes.bedfile SRR5947807.bam > bedfile.bam
-    bamstem = Path(bam).stem
-    bamfile = f"{outdir}core_{bamstem}.bam"
+    #  samtools view -u -L BiG-MAP.enzymes.bedfile SRR5947807.cram | samtools sort
+    cramstem = Path(cram).stem
+    corecram = f"{outdir}core_{cramstem}.cram"
     if os.path.exists(bedfile):
-        try:
-            cmd_extractcore = f"samtools view\
-            -b {bam}\
-            -L {bedfile}\
-            > {bamfile}"
-            res_extractcore = subprocess.check_output(cmd_extractcore, shell=True)
-            print(cmd_extractcore)
-        except(subprocess.CalledProcessError):
-            pass # raise error here
+        # -u keeps the intermediate stream uncompressed: it is only
+        # read once by samtools sort, so compressing would be wasted work
+        cmd_extractcore = ["samtools", "view", "-u", "--reference", reference,
+                           cram, "-L", bedfile]
+        cmd_coresort = ["samtools", "sort", "-@", str(io_threads),
+                        "--output-fmt", "cram", "--reference", reference,
+                        "-o", corecram, "-"]
+        p_extractcore = subprocess.Popen(cmd_extractcore, stdout = subprocess.PIPE)
+        p_coresort = subprocess.Popen(cmd_coresort, stdin = p_extractcore.stdout)
+        p_extractcore.stdout.close()
+        p_extractcore.wait()
+        p_coresort.wait()
+        if p_extractcore.returncode != 0 or p_coresort.returncode != 0:
+            # a half-written core cram must not survive the failure
+            if os.path.exists(corecram):
+                os.remove(corecram)
+            if p_extractcore.returncode != 0:
+                raise subprocess.CalledProcessError(p_extractcore.returncode, " ".join(cmd_extractcore))
+            raise subprocess.CalledProcessError(p_coresort.returncode, " ".join(cmd_coresort))
+        print(f"{' '.join(cmd_extractcore)} | {' '.join(cmd_coresort)}")
+        cmd_coreindex = ["samtools", "index", "-@", str(io_threads), corecram]
+        res_coreindex = subprocess.run(cmd_coreindex, check=True)
     else:
         # raise bedfile error here!!!
         pass
-    return(bamfile)
+    return(corecram)
 
 ######################################################################
 # RPKM and TPM counting
 ######################################################################
-def calculateTPM(countsfile):
-    """Calculates the TPM values for a sample 
+def parsecounts(sortedbam):
+    """parses the idxstats counts for a sorted bam into a dataframe
+    The samtools idxstats output is streamed straight into pandas, so
+    no intermediate counts file touches the disk. The read counts of
+    clusters that carry an --NR=x tag are divided by that number of
+    representatives, and the unmapped "*" entry is dropped.
+    parameters
+    ----------
+    sortedbam
+        string, the name of the sorted and indexed bam file
+    returns
+    ----------
+    df = dataframe with cluster, length and corrected nreads columns
+    """
+    cmd_count = ["samtools", "idxstats", sortedbam]
+    p_count = subprocess.Popen(cmd_count, stdout=subprocess.PIPE)
+    df = pd.read_csv(p_count.stdout, sep="\t", header=None,
+                     names=["cluster", "length", "nreads", "nnoreads"],
+                     dtype={"length": np.int64})
+    p_count.wait()
+    if p_count.returncode != 0:
+        # read_csv on an empty pipe would silently yield an empty frame
+        raise subprocess.CalledProcessError(p_count.returncode, " ".join(cmd_count))
+    df = df[df.cluster != "*"].copy()
+    df["nreads"] = df.nreads.astype(np.float64)
+    NR_mask = df.cluster.str.contains("NR")
+    NR = df.loc[NR_mask, "cluster"].str.split("--").str[-1].str.split("=").str[-1].astype(float)
+    df.loc[NR_mask, "nreads"] = df.loc[NR_mask, "nreads"] / NR
+    return(df)
+
+def calculateTPM(counts):
+    """Calculates the TPM values for a sample
     TPM = rate/sum(rate) * 10^6
     rate = nreads/cluster_length (kb)
     parameters
     ----------
-    counts_file
-        file containing the counts
-    core
-        bool, skip housekeeping genes
+    counts
+        dataframe with the counts from parsecounts()
     returns
     ----------
-    TPM = dictionary containing TPM counts per cluster
+    TPM = series containing TPM counts indexed per cluster
     """
-    rates = {}
-    ratesum = 0
-    with open(countsfile, "r") as f:
-        for line in f:
-            line = line.strip()
-            cluster, length, nreads, nnoreads = line.split("\t")
-            if "NR" in cluster:
-                    NR = float(cluster.split("--")[-1].split("=")[-1])
-                    nreads = float(nreads)/NR
-            try:
-                rate = float(nreads)/float(length)
-                rates[cluster] = rate
-                ratesum += rate
-            except(ZeroDivisionError):
-                pass
-    TPM = {}
-    for key in rates:
-        try:
-            TPM[key] = rates[key]/ratesum
-        except(ZeroDivisionError):
-            TPM[key] = 0
+    df = counts[counts.length > 0]
+    rate = df.nreads / df.length
+    TPM = (rate / rate.sum()).fillna(0)
+    TPM.index = df.cluster
     return(TPM)
 
-def calculateRPKM(countsfile):
-    """Calculates the RPKM values for a sample 
+def calculateRPKM(counts):
+    """Calculates the RPKM values for a sample
     RPKM = read_counts/(cluster_length * sum(read_counts)) * 10^9
     parameters
     ----------
-    counts_file
-        file containing the counts
+    counts
+        dataframe with the counts from parsecounts()
     returns
     ----------
-    RPKM = dictionary containing RPKM counts per cluster
+    RPKM = series containing RPKM counts indexed per cluster
     """
-    sum_reads = 0
-    read_counts = {}
-    cluster_lengths = {}
-    with open(countsfile, "r") as f:
-        for line in f:
-            if "*" not in line:
-                line = line.strip()
-                cluster, length, nreads, nnoreads = line.split("\t")
-                if "NR" in cluster:
-                    NR = float(cluster.split("--")[-1].split("=")[-1])
-                    nreads = float(nreads)/NR
-                    read_counts[cluster] = nreads
-                else:
-                    read_counts[cluster] = float(nreads)
-                cluster_lengths[cluster] = float(length)
-                sum_reads += float(nreads)
-
-    RPKM = {}
-    for key in read_counts:
-        try:
-            RPKM[key] = read_counts[key]/(sum_reads*cluster_lengths[key]) * 1000000000                    
-                
-        except(ZeroDivisionError):
-            RPKM[key] = 0
+    RPKM = counts.nreads / (counts.nreads.sum() * counts.length) * 1000000000
+    RPKM = RPKM.replace([np.inf, -np.inf], 0).fillna(0)
+    RPKM.index = counts.cluster
     return(RPKM)
 
-def parserawcounts(countsfile):
-    """parses the raw counts from a countsfile
+def parserawcounts(counts):
+    """parses the raw counts from the counts dataframe
     parameters
     ----------
-    counts_file
-        file containing the counts
+    counts
+        dataframe with the counts from parsecounts()
     returns
     ----------
-    raw_counts = dictionary containing raw counts per cluster
+    raw_counts = series containing raw counts indexed per cluster
     """
-    raw_counts = {}
-    with open(countsfile, "r") as f:
-        for line in f:
-            if "*" not in line:
-                line = line.strip()
-                cluster, length, nreads, nnoreads = line.split("\t")
-                if "NR" in cluster:
-                    NR = float(cluster.split("--")[-1].split("=")[-1])
-                    raw_counts[cluster] = float(nreads)/NR
-                else:
-                    raw_counts[cluster] = float(nreads)
-    return(raw_counts)
+    return(pd.Series(counts.nreads.values, index=counts.cluster))
     
 ######################################################################
-# Functions for analysing coverage with Bedtools genomecov
+# Functions for analysing coverage with samtools coverage
 ######################################################################
-def preparebedtools(outdir, reference):
-    """makes the -g genome.file for bedtools from a fasta file. This 
-    file is formatted as follows: 
-    fastaheader, length
-    hseq1, len(seq1)
-     :       : 
-    hseqn, len(seqn)
+def computetotalcoverage(sortedbam, reference):
+    """computes the total coverage of a gene cluster from the bam
+    samtools coverage reports the covered bases and reference length
+    for every cluster in a single pass over the sorted bam, so no
+    genome file or bedgraph is needed anymore.
     parameters
     ----------
-    outdir
-        string, the path of the output directory
+    sortedbam
+        string, the name of the sorted bam file
     reference
         string, the name of the reference fasta file (GCFs)
     returns
     ----------
-    genome_file = name of the by bedtools required genome file
-    """
-    c = ""
-    genome_file = f"{outdir}genome.file"
-    with open(genome_file, "w") as w:
-        with open(reference, "r") as f:
-            for line in f:
-                line = line.strip()
-                if line.startswith(">"):
-                    line = line.replace("core_", "")
-                    w.write(f"{c}\n")
-                    c = 0
-                    w.write(f"{line[1:]}\t")
-                else:
-                    c += len(line)
-            w.write(f"{c}")
-
-    #try:
-    #    # This could also be done using samtools idxstats and extracting $1 & $2
-    #    cmd_prepare = """awk \
-    #    '$0 ~ ">" {\
-    #         print c; \
-    #         c=0;\
-    #         printf substr($0,2,150) "\t";\
-    #         } \
-    #    $0 !~ ">" {\
-    #        c+=length($0);\
-    #    } \
-    #    END { \
-    #    print c; \
-    #    }\
-    #    ' %s > %s"""%(reference, genome_file) 
-    #    res_prepare = subprocess.check_output(cmd_prepare, shell=True)
-    #except(subprocess.CalledProcessError):
-    #    pass # raise error here
-
-    return(genome_file)
-    
-def bedtoolscoverage(gfile, outdir, sortedbam):
-    """computes the coverage for each mapped region
-    parameters
-    ----------
-    bedtoolspath
-        path to the bedtools installation
-    gfile
-        genome file build by preparebedtools()
-    outdir
-        string, the path of the output directory
-    sortedbam
-        name of the sorted bam file
-    returns
-    ----------
-    bg_file = the name of the bedgraph file
-    """
-    stem = Path(sortedbam).stem
-    bg_file = f"{outdir}{stem.split('.')[0]}.bg"
-    
-    try:
-        cmd_bedtools = f"bedtools genomecov -bga -ibam {sortedbam} -g {gfile} > {bg_file}"
-        res_bedtools = subprocess.check_output(cmd_bedtools, shell=True)
-    except(subprocess.CalledProcessError):
-        pass # raise error here
-    return(bg_file)
-
-def computetotalcoverage(bgfile):
-    """computes the total coverage of a gene cluster from a .bg file
-    parameters
-    ----------
-    bgfile
-        name of the bedgraph file
-    returns
-    ----------
     total_coverage = {cluster: totalcov}
     """
-    nocov = {}                                                 
-    clusterlen = {}                                            
-    with open(bgfile, "r") as f:                               
-        for line in f:                                         
-            line = line.strip()                                
-            cluster, start, end, cov = line.split("\t")
-            clusterlen[cluster] = float(end) # last encounter is length
-            if not cluster in nocov: # make entry
-                nocov[cluster] = 0
-            if float(cov) == 0: # enter no coverage values
-                    nocov[cluster] += (float(end)-float(start))
-    total_coverage = {}
-    for key in nocov.keys():
-        perc = (clusterlen[key] - nocov[key])/clusterlen[key]
-        # Set treshold here!!!
-        total_coverage[key] = perc
-    return(total_coverage)
-
-def computecorecoverage(bedgraph, bedfile):
+    cmd_coverage = ["samtools", "coverage", "--reference", reference, sortedbam]
+    p_coverage = subprocess.Popen(cmd_coverage, stdout=subprocess.PIPE)
+    cov = pd.read_csv(p_coverage.stdout, sep="\t", header=None, skiprows=1,
+                      names=["cluster", "startpos", "endpos", "numreads", "covbases",
+                             "coverage", "meandepth", "meanbaseq", "meanmapq"])
+    p_coverage.wait()
+    if p_coverage.returncode != 0:
+        # read_csv on an empty pipe would silently yield an empty frame
+        raise subprocess.CalledProcessError(p_coverage.returncode, " ".join(cmd_coverage))
+    # Set treshold here!!!
+    total_coverage = cov.covbases / cov.endpos
+    return(dict(zip(cov.cluster, total_coverage)))
+
+def computecorecoverage(sortedbam, bedfile, reference):
     """computes the core "enzymatic" coverage for gene clusters
     EXPLANATION:
     This computation is based on the bedfile that contains the
-    coordinates for the enzymatic genes. What happens is that the
-    algorithm finds entries that have 0 coverage, and compares if the
-    regions of these entries are within the enzymatic core
-    regions. Based on this, certain computations will be made as
-    defined in the local function. In the end, the amount of bases for
-    which 0 coverage was found are added up, and then substracted from
-    the total length of the core:
-    core_coverage = (length_core - bases_not_covered)/length_core
+    coordinates for the enzymatic genes. samtools bedcov reads the
+    depth for exactly these regions straight from the sorted bam, and
+    with -d 1 it reports the number of bases with depth of at least 1
+    per region as an extra column. Summing that column per cluster and
+    dividing by the summed core length gives:
+    core_coverage = bases_covered/length_core
     EXAMPLE:
-    say that of a core of length 3000 340 bases are not covered, then:
-    core_coverage = (3000-340)/3000 = 0.887
+    say that of a core of length 3000 2660 bases are covered, then:
+    core_coverage = 2660/3000 = 0.887
     parameters
     ----------
-    bedgraph
-        name of the bedgraph file
+    sortedbam
+        string, the name of the sorted and indexed bam file
     bedfile
-        the name of the bedfile with core coordinates        
+        the name of the bedfile with core coordinates
+    reference
+        string, the name of the reference fasta file (GCFs)
     returns
     ----------
     core_coverage = dict, {cluster: corecov}
     """
-    def local_computecov(start_list, end_list, local_entry):
-        """Computes the local cov value
-        Ls = local entry start 
-        Le = local entry end
-        Ts = true start of core gene 
-        Te = true end of core gene 
-        parameters
-        ----------
-        start_list
-            list, all the start coords for the enzymatic core genes
-        end_list
-            list, all the start coords for the enzymatic core genes
-        local_entry
-            list, [start, end] of local entry
-        returns
-        ----------
-        local_cov = int, value for not covered bases for entry
-        """
-        ret_cov = 0
-        Ls = local_entry[0]
-        Le = local_entry[1]
-        for Ts, Te in zip(start_list, end_list):
-            if Ls>Ts and Ls<Te and Le>Ts and Le<Te:
-                # in
-                ret_cov += Le-Ls
-            if Ls<Ts and Ls<Te and Le>Ts and Le<Te:
-                # start out
-                ret_cov += Le-Ts
-            if Ls>Ts and Ls<Te and Le>Ts and Le>Te:
-                # end out
-                ret_cov += Te-Ls  
-            if Ls<Ts and Ls<Te and Le>Ts and Le>Te:
-                # start&end out
-                ret_cov += Te-Ts
-        return(ret_cov)
-    # Parsing bedfile for Ts, Te, and core lengths:
-    core_starts = {}
-    core_ends = {}
-    core_lengths = {}
-    with open(bedfile, "r") as bf:
-        for line in bf:
-            line = line.strip()
-            clust, start, end = line.split("\t")
-            if not clust in core_lengths.keys():
-                core_lengths[clust] = 0
-            core_lengths[clust] += int(end) - int(start)
-            if not clust in core_starts.keys():
-                core_starts[clust] = []
-            if not clust in core_ends.keys():
-                core_ends[clust] = []
-            core_starts[clust].append(int(start))
-            core_ends[clust].append(int(end))
-    # Parsing bedgraph for entries
-    nocov = {}                                                 
-    with open(bedgraph, "r") as f:                               
-        for line in f:                                         
-            line = line.strip()                                
-            cluster, start, end, cov = line.split("\t")
-            #if "--NR" in cluster_NR:
-            #    NR_index = cluster_NR.find("--NR")
-            #    cluster = cluster_NR[:NR_index]
-            #else:
-            #    cluster = cluster_NR
-            if not cluster in nocov: # make entry
-                nocov[cluster] = 0
-            if float(cov) == 0: # enter no coverage values
-                not_covered = local_computecov(core_starts[cluster], core_ends[cluster], [int(start), int(end)])
-                nocov[cluster] += not_covered
+    cmd_bedcov = ["samtools", "bedcov", "--reference", reference, "-d", "1", bedfile, sortedbam]
+    p_bedcov = subprocess.Popen(cmd_bedcov, stdout=subprocess.PIPE)
+    cores = pd.read_csv(p_bedcov.stdout, sep="\t", header=None,
+                        names=["cluster", "start", "end", "sumcov", "covbases"])
+    p_bedcov.wait()
+    if p_bedcov.returncode != 0:
+        # read_csv on an empty pipe would silently yield an empty frame
+        raise subprocess.CalledProcessError(p_bedcov.returncode, " ".join(cmd_bedcov))
+    core_lengths = (cores.end - cores.start).groupby(cores.cluster).sum()
+    covered_bases = cores.groupby("cluster").covbases.sum()
     # Final coverage calculation:
-    total_coverage = {}
-    for key in nocov.keys():
-        perc = (core_lengths[key] - nocov[key])/core_lengths[key]
-        total_coverage[key] = perc
-    return(total_coverage)
+    total_coverage = covered_bases / core_lengths
+    return(total_coverage.to_dict())
 
 
 
-def familycorrect(c_dict, family):
+def familycorrect(c_values, family):
     """uses family to change values
     parameters
     ----------
-    c_dict
-        dictionary, {clustername:value}
+    c_values
+        series or dict, {clustername:value}
     family
         json, {HGF representative: HGF members}
+    returns
+    ----------
+    ret = series with the HGF members expanded, indexed per cluster
     """
     ret = {}
     with open(family, "r") as j:
         family = json.load(j)
-    
-    for GC, v in c_dict.items():
+
+    for GC, v in c_values.items():
         if "HG_DNA"in GC:
             for HGF_member in family[GC]:
                 key_NR = GC[GC.index("--NR"):]
                 ret[f"{HGF_member}{key_NR}"] = v
         else:
             ret[GC] = v
-    return(ret)
+    return(pd.Series(ret))
 
 
 
@@ -679,7 +511,7 @@ def writejson(dictionary, outdir, outfile_name):
     """
     outfile = f"{outdir}{outfile_name}"
     with open(outfile, "w") as w:
-        w.write(json.dumps(dictionary, indent=4))
+        json.dump(dictionary, w, indent=4)
     return(outfile)
 
 def export2biom(outdir, core = ""):
@@ -693,22 +525,23 @@ def export2biom(outdir, core = ""):
     biom_file = the created biom-format file (without metadata)
     """    
     biom_file = f"{outdir}BiG-MAP.map{core}.biom"
-    cmd_export2biom = f"biom convert -i {outdir}BiG-MAP.map.results.{core}RPKM_filtered.txt -o {biom_file} --table-type='Pathway table' --to-json"
-    res_export = subprocess.check_output(cmd_export2biom, shell=True)
+    cmd_export2biom = ["biom", "convert",
+                       "-i", f"{outdir}BiG-MAP.map.results.{core}RPKM_filtered.txt",
+                       "-o", biom_file,
+                       "--table-type=Pathway table", "--to-json"]
+    res_export = subprocess.run(cmd_export2biom, check=True)
     return(biom_file)
 
 def decoratebiom(biom_file, outdir, metadata, core = ""):
     """inserts rows and column data
     """
-    cmd_sample = f"biom add-metadata -i {biom_file} -o {biom_file} -m {metadata}"
-    res_add = subprocess.check_output(cmd_sample, shell=True)
+    cmd_sample = ["biom", "add-metadata", "-i", biom_file, "-o", biom_file, "-m", metadata]
+    res_add = subprocess.run(cmd_sample, check=True)
     if core == "core":
-        cmd_feature = f"biom add-metadata --observation-metadata-fp {outdir}BiG-MAP.map.core.coverage.txt -i {biom_file} -o {biom_file}"
-        res_feature = subprocess.check_output(cmd_feature, shell=True)
-    with open(biom_file, "r") as f:
-        biom_dict = json.load(f)
-    with open(biom_file, "w") as w:
-        w.write(json.dumps(biom_dict, indent=4))
+        cmd_feature = ["biom", "add-metadata",
+                       "--observation-metadata-fp", f"{outdir}BiG-MAP.map.core.coverage.txt",
+                       "-i", biom_file, "-o", biom_file]
+        res_feature = subprocess.run(cmd_feature, check=True)
     return(biom_file)
 
 def purge(d, pattern):
@@ -722,34 +555,121 @@ def purge(d, pattern):
     returns
     ----------
     """
-    for f in os.listdir(d):
-        if re.search(pattern, f):
-            os.remove(os.path.join(d, f))        
-
-def movetodir(outdir, dirname, pattern):
-    """moves files matching a patterd into new directory
+    matcher = re.compile(pattern)
+    with os.scandir(d) as entries:
+        for entry in entries:
+            if matcher.search(entry.name):
+                os.remove(os.path.join(d, entry.name))
+
+def movetodir(outdir, rules):
+    """moves files matching extensions into new directories
+    The output directory is scanned only once: every entry is matched
+    against the suffixes and moved into the directory of the first
+    rule that matches. All cleanup rules are plain extension matches,
+    so str.endswith suffices; purge() remains available for patterns
+    that really need a regex.
     parameters
     ----------
     outdir
         string, the path to output directory
-    dirname
-        string, name of the new direcory
-    pattern
-        string, regex
+    rules
+        list of (dirname, suffix) tuples, with dirname the name of
+        the new directory and suffix the file extension to match;
+        a suffix may also be a tuple of extensions
     returns
     ----------
     None
     """
-    # Make directory
-    try:
-        os.mkdir(f"{outdir}{dirname}")
-        print(f"Directory {outdir}{dirname} created")
-    except(FileExistsError):
-        print(f"Directory {outdir}{dirname} already exists")
-    # Move files into new directory
-    for f in os.listdir(outdir):
-        if re.search(pattern, f):
-            shutil.move(os.path.join(outdir,f), os.path.join(outdir, dirname))
+    # Make directories
+    for dirname in dict.fromkeys(dirname for dirname, suffix in rules):
+        try:
+            os.mkdir(f"{outdir}{dirname}")
+            print(f"Directory {outdir}{dirname} created")
+        except(FileExistsError):
+            print(f"Directory {outdir}{dirname} already exists")
+    # Move files into the new directories
+    with os.scandir(outdir) as entries:
+        for entry in entries:
+            for dirname, suffix in rules:
+                if entry.name.endswith(suffix):
+                    shutil.move(os.path.join(outdir, entry.name), os.path.join(outdir, dirname))
+                    break
+
+######################################################################
+# Per-sample pipeline
+######################################################################
+def process_sample(mate1, mate2, index, args):
+    """runs the full mapping pipeline for one sample
+    Every sample is independent of the others, so this function can be
+    farmed out to a multiprocessing worker: map+sort, index, count,
+    coverage, the GCF/HGF correction and (optionally) the same chain
+    for the core regions.
+    parameters
+    ----------
+    mate1
+    mate2
+    index
+        string, the stemname of the bowtie2 index
+    args
+        argparse.Namespace, the parsed command line arguments
+    returns
+    ----------
+    sample_df = dataframe with the TPM/RPKM/RAW/cov columns for this
+    sample, indexed by gene cluster
+    """
+    sortb = bowtie2_map_sort(args.outdir, mate1, mate2, index, args.fasta, args.bowtie2_setting, args.threads, args.io_threads, args.reference)
+    indexbam(sortb, args.outdir, args.io_threads)
+    counts = parsecounts(sortb)
+    TPM =  calculateTPM(counts)
+    RPKM = calculateRPKM(counts)
+    raw = parserawcounts(counts)
+
+    ##############################
+    # samtools: coverage
+    ##############################
+    coverage = computetotalcoverage(sortb, args.reference)
+
+    # GCF and HGF consideration:
+    TPM = familycorrect(TPM, args.family)
+    RPKM = familycorrect(RPKM, args.family)
+    raw = familycorrect(raw, args.family)
+    coverage = familycorrect(coverage, args.family)
+
+    ##############################
+    # saving results in one dataframe
+    ##############################
+    sample = Path(sortb).stem.split(".")[0]
+    sample_df = pd.DataFrame({f"{sample}.TPM": TPM,
+                              f"{sample}.RPKM": RPKM,
+                              f"{sample}.RAW": raw,
+                              f"{sample}.cov": coverage})
+
+    ##############################
+    # Core calculation
+    ##############################
+    if args.corecalculation:
+        sortb = extractcorefrombam( sortb, args.outdir, args.corecalculation, args.io_threads, args.reference)
+        core_counts = parsecounts(sortb)
+        core_TPM =  calculateTPM(core_counts)
+        core_RPKM = calculateRPKM(core_counts)
+        core_raw = parserawcounts(core_counts)
+        # Coverage
+        core_coverage = computecorecoverage(sortb, args.corecalculation, args.reference)
+        # GCF and HGF consideration:
+        core_TPM = familycorrect(core_TPM, args.family)
+        core_RPKM = familycorrect(core_RPKM, args.family)
+        core_raw = familycorrect(core_raw, args.family)
+        core_coverage = familycorrect(core_coverage, args.family)
+        # only the gene clusters have core regions, the HGs get 0:
+        core_coverage = core_coverage.reindex(core_RPKM.index, fill_value=0)
+        core_coverage = core_coverage.where(core_coverage.index.str.contains("GC_DNA--"), 0)
+        core_df = pd.DataFrame({f"{sample}.coreTPM": core_TPM,
+                                f"{sample}.coreRPKM": core_RPKM,
+                                f"{sample}.coreRAW": core_raw,
+                                f"{sample}.corecov": core_coverage})
+        sample_df = pd.concat([sample_df, core_df], axis=1)
+    sample_df.index.name = "gene_clusters"
+    return(sample_df)
 
 ######################################################################
 # MAIN
@@ -759,7 +679,7 @@ def main():
     The following steps are performed for each sample
     1) preparation of mapping (=alignment)
     2) bowtie2 for mapping, counting reads
-    3) bedtools for computing coverage for each cluster
+    3) samtools for computing coverage for each cluster
     4) using the fastANI result for adding HGF values
     5) saving all the results in dictionary (=memory)
     5) writing the results to .json (=BIOM) and .csv 
@@ -784,99 +704,46 @@ def main():
 
     
 
-    results = {} #Will be filled with TPM,RPKM,coverage for each sample
-    results_core = {}
     mapping_percentages = {} #Mappping percs for each sample
-    
+
     ##############################
     # Preparing mapping
     ##############################
     i = bowtie2_index( args.reference, args.outdir)
 
+    # Divide the thread budgets over the parallel sample pipelines:
+    if args.parallel > 1:
+        args.threads = max(1, args.threads // args.parallel)
+        args.io_threads = max(1, args.io_threads // args.parallel)
+
     ##############################
     # Whole cluster calculation
     ##############################
-    for m1, m2 in fastq_files:
-        s = bowtie2_map(args.outdir, m1, m2, i, args.fasta, args.bowtie2_setting, args.threads)
-        b = samtobam(s, args.outdir)
-        sortb = sortbam(b, args.outdir)
-        indexbam(sortb, args.outdir)
-        countsfile = countbam(sortb, args.outdir)
-        TPM =  calculateTPM(countsfile)
-        RPKM = calculateRPKM(countsfile)
-        raw = parserawcounts(countsfile)
-
-        ##############################
-        # bedtools: coverage
-        ##############################
-        bedtools_gfile = preparebedtools(args.outdir, args.reference)
-        bedgraph = bedtoolscoverage(bedtools_gfile, args.outdir, sortb)
-        coverage = computetotalcoverage(bedgraph)
-
-        # GCF and HGF consideration:
-        TPM = familycorrect(TPM, args.family)
-        RPKM = familycorrect(RPKM, args.family)
-        raw = familycorrect(raw, args.family)
-        coverage = familycorrect(coverage, args.family)
-
-        ##############################
-        # saving results in one dictionary
-        ##############################
-        sample = Path(b).stem
-        results[f"{sample}.TPM"] = [TPM[k] for k in RPKM.keys()]
-        results[f"{sample}.RPKM"] = [RPKM[k] for k in RPKM.keys()]
-        results[f"{sample}.RAW"] = [raw[k] for k in RPKM.keys()]
-        results[f"{sample}.cov"] = [coverage[k] for k in RPKM.keys()]
-        results["gene_clusters"] = list(RPKM.keys()) # add gene clusters as well
-
-        ##############################
-        # Core calculation
-        ##############################
-        if args.corecalculation:
-            sortb = extractcorefrombam( sortb, args.outdir, args.corecalculation)
-            indexbam( sortb, args.outdir)
-            countsfile = countbam(sortb, args.outdir)
-            core_TPM =  calculateTPM(countsfile)
-            core_RPKM = calculateRPKM(countsfile)
-            core_raw = parserawcounts(countsfile)
-            # Coverage
-            core_bedgraph = bedtoolscoverage(bedtools_gfile, args.outdir, sortb)
-            core_coverage = computecorecoverage(core_bedgraph, args.corecalculation)
-            # GCF and HGF consideration:
-            core_TPM = familycorrect(core_TPM, args.family)
-            core_RPKM = familycorrect(core_RPKM, args.family)
-            core_raw = familycorrect(core_raw, args.family)
-            core_coverage = familycorrect(core_coverage, args.family)
-            #core_coverage = computetotalcoverage(core_bedgraph)
-            results[f"{sample}.coreTPM"] = [core_TPM[k] for k in core_RPKM.keys()]
-            results[f"{sample}.coreRPKM"] = [core_RPKM[k] for k in core_RPKM.keys()]
-            results[f"{sample}.coreRAW"] = [core_raw[k] for k in core_RPKM.keys()]
-            results[f"{sample}.corecov"] = [core_coverage[k] if "GC_DNA--" in k else 0 for k in core_RPKM.keys()]
-            
+    sample_jobs = [(m1, m2, i, args) for m1, m2 in fastq_files]
+    with multiprocessing.Pool(args.parallel) as pool:
+        sample_dfs = pool.starmap(process_sample, sample_jobs)
 
     ##############################
     # writing results file: pandas
     ##############################
     # writing all the results to csv
-    df = pd.DataFrame(results)
-    df.set_index("gene_clusters", inplace=True)
+    df = pd.concat(sample_dfs, axis=1)
     df.to_csv(f"{args.outdir}BiG-MAP.map.results.ALL.csv")
-    
-    # writing RPKM (core) filtered results
-    headers_RPKM = [rpkmkey for rpkmkey in results.keys() if ".RPKM" in rpkmkey]
+
+    # writing RPKM (core) filtered results; serialized once as the
+    # tab-separated .txt that biom convert consumes downstream
+    headers_RPKM = [rpkmkey for rpkmkey in df.columns if ".RPKM" in rpkmkey]
     df_RPKM = df[headers_RPKM]
     df_RPKM.columns = [h[:-5] for h in headers_RPKM]
-    df_RPKM.to_csv(f"{args.outdir}BiG-MAP.map.results.RPKM_filtered.csv")
     df_RPKM.to_csv(f"{args.outdir}BiG-MAP.map.results.RPKM_filtered.txt", sep="\t")
 
-    headers_coreRPKM = [rpkmkey for rpkmkey in results.keys() if ".coreRPKM" in rpkmkey]
+    headers_coreRPKM = [rpkmkey for rpkmkey in df.columns if ".coreRPKM" in rpkmkey]
     df_coreRPKM = df[headers_coreRPKM]
     df_coreRPKM.columns = [h[:-9] for h in headers_coreRPKM]
-    df_coreRPKM.to_csv(f"{args.outdir}BiG-MAP.map.results.coreRPKM_filtered.csv")
     df_coreRPKM.to_csv(f"{args.outdir}BiG-MAP.map.results.coreRPKM_filtered.txt", sep="\t")
 
     # Writing row coverages:
-    headers_cov = [corekey for corekey in results.keys() if ".corecov" in corekey]
+    headers_cov = [corekey for corekey in df.columns if ".corecov" in corekey]
     df_cov = df[headers_cov]
     df_cov.columns = [h[:-8] for h in headers_cov if ".corecov" in h]
     df_cov.index.names = ['#gene_clusters']
@@ -904,16 +771,12 @@ def main():
     ##############################
     # Moving and purging files
     ##############################
-    movetodir(args.outdir, "bowtie2-index", ".bt2")
-    movetodir(args.outdir, "bedtools-results", ".bg")
-    movetodir(args.outdir, "bedtools-results", ".file")
-    movetodir(args.outdir, "bowtie2-map-results", ".bam")
-    movetodir(args.outdir, "bowtie2-map-results", ".sam")
-    movetodir(args.outdir, "bowtie2-map-results", ".bai")
-    movetodir(args.outdir, "bowtie2-raw-counts", ".count")
-    movetodir(args.outdir, "csv-results", ".csv")
-    movetodir(args.outdir, "csv-results", ".txt")
-    movetodir(args.outdir, "biom-results", ".biom")
+    movetodir(args.outdir, [("bowtie2-index", (".bt2", ".bt2l")),
+                            ("bowtie2-map-results", ".cram"),
+                            ("bowtie2-map-results", ".crai"),
+                            ("csv-results", ".csv"),
+                            ("csv-results", ".txt"),
+                            ("biom-results", ".biom")])
     
 if __name__ == "__main__":
     main()